@@ -2,20 +2,41 @@
 """
 Telegram Bot (Parts & Prices)
 - python-telegram-bot v20
-- Webhook ready for Render
+- Webhook ready for Render (PTB built-in webhook server)
 - Inline keyboard Persian
-- Cart stored locally (carts.json)
+- Carts stored locally in SQLite (carts.db)
 - Admin receives order
 """
 
 import os
 import json
+import fcntl
+import asyncio
+import functools
 import logging
-from typing import Dict, Any
-from flask import Flask, request
+import sqlite3
+from collections import OrderedDict, defaultdict
+from typing import Dict, Any, Set
+
+# orjson is much faster at (de)serializing the cart blobs; fall back to
+# stdlib json when it is not installed.
+try:
+    import orjson
+
+    def _dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    _loads = json.loads
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CallbackQueryHandler,
     CommandHandler,
@@ -34,14 +55,15 @@ if not BOT_TOKEN or not ADMIN_CHAT_ID or not WEBHOOK_URL:
 ADMIN_CHAT_ID_INT = int(ADMIN_CHAT_ID)
 
 # --- Logging ---
-logging.basicConfig(level=logging.INFO)
+# LOG_LEVEL=WARNING in production keeps hot handlers from paying for
+# log formatting; all log calls use lazy %-style arguments.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.INFO))
 logger = logging.getLogger(__name__)
 
-# --- Flask app for Webhook ---
-app = Flask(__name__)
-
 # --- Data & Utilities ---
-CARTS_FILE = "carts.json"
+CARTS_DB = "carts.db"
+LEGACY_CARTS_FILE = "carts.json"
 CARS = {
     "پراید": ["111", "131", "141"],
     "پژو": ["405", "پارس", "207"],
@@ -50,204 +72,481 @@ CARS = {
 TIRES_PRICES = {"خارجی": {"185": 185, "195": 195, "205": 205}, "داخلی": {"185": 185, "195": 195, "205": 205}}
 OTHER_PARTS_PRICES = {"لایت‌بک خارجی": 205, "آینه بغل": 120, "شیشه جلو": 250, "شیشه عقب": 200}
 
-def load_carts() -> Dict[str, Any]:
-    if not os.path.exists(CARTS_FILE):
-        return {}
+# Menu key -> (display name, price). The menu shows the generic "لایت‌بک"
+# button, which resolves to the imported variant.
+PART_META = {k: (k, v) for k, v in OTHER_PARTS_PRICES.items()}
+PART_META["لایت‌بک"] = ("لایت‌بک خارجی", OTHER_PARTS_PRICES["لایت‌بک خارجی"])
+
+# callback_data carries small integer indexes into these tables instead
+# of the Persian names themselves: UTF-8 names can exceed Telegram's
+# 64-byte callback_data limit and cost extra split/decode work per click.
+CAR_IDX = list(CARS)
+TIRE_IDX = list(TIRES_PRICES)
+TIRE_SIZES = {t: list(sizes) for t, sizes in TIRES_PRICES.items()}
+MENU_PARTS = ["لایت‌بک", "آینه بغل", "شیشه جلو", "شیشه عقب"]
+
+class Item:
+    """One cart line. __slots__ keeps per-item memory small; the dict
+    shape only exists at (de)serialization time."""
+    __slots__ = ("car", "model", "name", "meta", "price", "qty")
+
+    def __init__(self, car: str, model: str, name: str, meta: str, price: int, qty: int = 1):
+        self.car = car
+        self.model = model
+        self.name = name
+        self.meta = meta
+        self.price = price
+        self.qty = qty
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "car": self.car,
+            "model": self.model,
+            "name": self.name,
+            "meta": self.meta,
+            "price": self.price,
+            "qty": self.qty,
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Item":
+        return cls(d["car"], d["model"], d["name"], d["meta"], d["price"], d.get("qty", 1))
+
+def _init_db() -> sqlite3.Connection:
+    # check_same_thread=False: the flusher pushes its writes to a worker
+    # thread so a slow fsync never stalls the event loop.
+    db = sqlite3.connect(CARTS_DB, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS carts (uid TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    _migrate_legacy_carts(db)
+    return db
+
+def _migrate_legacy_carts(db: sqlite3.Connection):
+    """One-time import of the old carts.json file, if it is still around."""
+    if not os.path.exists(LEGACY_CARTS_FILE):
+        return
     try:
-        with open(CARTS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(LEGACY_CARTS_FILE, "r", encoding="utf-8") as f:
+            carts = json.load(f)
     except Exception:
-        return {}
+        logger.exception("Could not read legacy carts file, skipping migration")
+        return
+    for uid, cart in carts.items():
+        db.execute(
+            "INSERT OR IGNORE INTO carts(uid, data) VALUES(?, ?)",
+            (uid, _dumps(cart)),
+        )
+    os.rename(LEGACY_CARTS_FILE, LEGACY_CARTS_FILE + ".bak")
+    logger.info("Migrated %d carts from %s", len(carts), LEGACY_CARTS_FILE)
+
+_db = _init_db()
 
-def save_carts(carts: Dict[str, Any]):
-    with open(CARTS_FILE, "w", encoding="utf-8") as f:
-        json.dump(carts, f, ensure_ascii=False, indent=2)
+# In-memory cache is the source of truth while the process runs; dirty
+# entries are flushed to SQLite in batches by a background flusher that
+# wakes on the first mutation and debounces briefly to coalesce bursts.
+# The cache is LRU-bounded so idle users cannot grow RSS forever;
+# evicted entries are reloaded from SQLite on their next access.
+CARTS_CACHE: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+CACHE_MAX = 10_000
+DIRTY: Set[int] = set()
+FLUSH_DEBOUNCE = 0.5
+_dirty_event = asyncio.Event()
+_flush_lock = asyncio.Lock()
+
+# Serializes read-modify-write cycles per user; different users never
+# contend with each other.
+USER_LOCKS: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+def _decode_cart(data) -> Dict[str, Any]:
+    cart = _loads(data)
+    cart["items"] = [Item.from_dict(d) for d in cart.get("items", [])]
+    return cart
+
+def _load_cache():
+    for uid, data in _db.execute("SELECT uid, data FROM carts"):
+        CARTS_CACHE[int(uid)] = _decode_cart(data)
+    _evict_overflow()
+
+def _evict_overflow():
+    while len(CARTS_CACHE) > CACHE_MAX:
+        key, cart = CARTS_CACHE.popitem(last=False)
+        if key in DIRTY:
+            # Persist before dropping so the mutation is not lost; an
+            # empty (cleared) cart becomes a DELETE, as in flush_dirty.
+            DIRTY.discard(key)
+            items = cart.get("items", [])
+            payload = _dumps({"items": [it.as_dict() for it in items]}) if items else None
+            _write_rows([(key, payload)])
 
 def get_cart(user_id: int) -> Dict[str, Any]:
-    carts = load_carts()
-    key = str(user_id)
-    if key not in carts:
-        carts[key] = {"items": []}
-        save_carts(carts)
-    return carts[key]
+    cart = CARTS_CACHE.get(user_id)
+    if cart is not None:
+        CARTS_CACHE.move_to_end(user_id)
+        return cart
+    row = _db.execute("SELECT data FROM carts WHERE uid=?", (user_id,)).fetchone()
+    if row is None:
+        # Unknown user: hand out a throwaway empty cart. It only enters
+        # the cache (and storage) if update_cart is actually called.
+        return {"items": []}
+    cart = _decode_cart(row[0])
+    CARTS_CACHE[user_id] = cart
+    _evict_overflow()
+    return cart
+
+def _mark_dirty(uid: int):
+    DIRTY.add(uid)
+    _dirty_event.set()
 
 def update_cart(user_id: int, cart: Dict[str, Any]):
-    carts = load_carts()
-    carts[str(user_id)] = cart
-    save_carts(carts)
+    CARTS_CACHE[user_id] = cart
+    CARTS_CACHE.move_to_end(user_id)
+    _mark_dirty(user_id)
+    _evict_overflow()
 
 def clear_cart(user_id: int):
-    carts = load_carts()
-    carts.pop(str(user_id), None)
-    save_carts(carts)
+    # Keep an empty cart in the cache rather than popping the key:
+    # until the flusher's DELETE lands, a cache miss would re-read the
+    # stale row from SQLite and resurrect the cleared cart.
+    update_cart(user_id, {"items": []})
+
+def _write_rows(rows):
+    for key, payload in rows:
+        if payload is None:
+            _db.execute("DELETE FROM carts WHERE uid=?", (key,))
+        else:
+            _db.execute(
+                "INSERT OR REPLACE INTO carts(uid, data) VALUES(?, ?)",
+                (key, payload),
+            )
+
+async def flush_dirty():
+    async with _flush_lock:
+        dirty = DIRTY.copy()
+        DIRTY.clear()
+        if not dirty:
+            return
+        # Serialize on the loop (cheap, keeps a consistent snapshot),
+        # then hand the blocking writes to a worker thread.
+        rows = []
+        for key in dirty:
+            cart = CARTS_CACHE.get(key)
+            if cart is None or not cart.get("items"):
+                # Cleared (or evicted-empty) carts become a DELETE.
+                rows.append((key, None))
+            else:
+                rows.append((key, _dumps({"items": [it.as_dict() for it in cart["items"]]})))
+        try:
+            await asyncio.to_thread(_write_rows, rows)
+        except Exception:
+            # Put the keys back so the next flush retries them.
+            DIRTY.update(dirty)
+            _dirty_event.set()
+            raise
+        logger.debug("Flushed %d dirty carts", len(dirty))
+
+async def _flusher():
+    while True:
+        await _dirty_event.wait()
+        _dirty_event.clear()
+        # Short debounce so a burst of clicks collapses into one flush.
+        await asyncio.sleep(FLUSH_DEBOUNCE)
+        try:
+            await flush_dirty()
+        except Exception:
+            # Keep the flusher alive; the dirty keys were re-marked and
+            # will be retried on the next wake-up.
+            logger.exception("Cart flush failed, will retry")
+
+# Handle to the running flusher task; created in post_init, cancelled
+# in post_shutdown. Application.create_task is unsuitable here: before
+# start() it warns and drops the reference, after start() stop() would
+# block forever awaiting the infinite loop.
+_flusher_task = None
+
+async def _start_flusher(application):
+    global _flusher_task
+    _flusher_task = asyncio.create_task(_flusher())
+
+async def _flush_on_shutdown(application):
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        try:
+            await _flusher_task
+        except asyncio.CancelledError:
+            pass
+    await flush_dirty()
+
+_load_cache()
 
 # --- Keyboards ---
+# All of these are pure functions of the constant CARS/price tables, so
+# the markups are built once and reused (memoized or precomputed below).
 def main_menu_keyboard():
-    buttons = [InlineKeyboardButton(text=car, callback_data=f"car|{car}") for car in CARS.keys()]
+    buttons = [InlineKeyboardButton(text=car, callback_data=f"car|{ci}") for ci, car in enumerate(CAR_IDX)]
     buttons.append(InlineKeyboardButton(text="🧾 سبد خرید", callback_data="view_cart"))
     kb = [buttons[i : i + 2] for i in range(0, len(buttons), 2)]
     return InlineKeyboardMarkup(kb)
 
-def models_keyboard(car_name: str):
-    models = CARS.get(car_name, [])
-    kb = [[InlineKeyboardButton(text=m, callback_data=f"model|{car_name}|{m}")] for m in models]
+MAIN_MENU = main_menu_keyboard()
+
+@functools.lru_cache(maxsize=None)
+def models_keyboard(ci: int):
+    models = CARS[CAR_IDX[ci]]
+    kb = [[InlineKeyboardButton(text=m, callback_data=f"model|{ci}|{mi}")] for mi, m in enumerate(models)]
     kb.append([InlineKeyboardButton(text="🔙 برگشت", callback_data="back_main")])
     kb.append([InlineKeyboardButton(text="🧾 سبد خرید", callback_data="view_cart")])
     return InlineKeyboardMarkup(kb)
 
-def model_options_keyboard(car_name: str, model: str):
+@functools.lru_cache(maxsize=None)
+def model_options_keyboard(ci: int, mi: int):
     kb = [
-        [InlineKeyboardButton(text="لاستیک خارجی", callback_data=f"tires_type|{car_name}|{model}|خارجی")],
-        [InlineKeyboardButton(text="لاستیک داخلی", callback_data=f"tires_type|{car_name}|{model}|داخلی")],
-        [InlineKeyboardButton(text="لایت‌بک", callback_data=f"part|{car_name}|{model}|لایت‌بک")],
-        [InlineKeyboardButton(text="آینه بغل", callback_data=f"part|{car_name}|{model}|آینه بغل")],
-        [InlineKeyboardButton(text="شیشه جلو", callback_data=f"part|{car_name}|{model}|شیشه جلو")],
-        [InlineKeyboardButton(text="شیشه عقب", callback_data=f"part|{car_name}|{model}|شیشه عقب")],
-        [InlineKeyboardButton(text="🔙 برگشت", callback_data=f"back_models|{car_name}")],
-        [InlineKeyboardButton(text="🏠 منو اصلی", callback_data="back_main")],
-        [InlineKeyboardButton(text="🧾 سبد خرید", callback_data="view_cart")]
+        [InlineKeyboardButton(text=f"لاستیک {t}", callback_data=f"tires_type|{ci}|{mi}|{ti}")]
+        for ti, t in enumerate(TIRE_IDX)
     ]
+    kb.extend(
+        [InlineKeyboardButton(text=p, callback_data=f"part|{ci}|{mi}|{pi}")]
+        for pi, p in enumerate(MENU_PARTS)
+    )
+    kb.append([InlineKeyboardButton(text="🔙 برگشت", callback_data=f"back_models|{ci}")])
+    kb.append([InlineKeyboardButton(text="🏠 منو اصلی", callback_data="back_main")])
+    kb.append([InlineKeyboardButton(text="🧾 سبد خرید", callback_data="view_cart")])
     return InlineKeyboardMarkup(kb)
 
-def tires_size_keyboard(car_name: str, model: str, tire_type: str):
+@functools.lru_cache(maxsize=None)
+def tires_size_keyboard(ci: int, mi: int, ti: int):
     kb = []
-    prices = TIRES_PRICES.get(tire_type, {})
-    for size, price in prices.items():
-        cb = f"add_item|{car_name}|{model}|لاستیک {tire_type}|{size}|{price}"
+    prices = TIRES_PRICES[TIRE_IDX[ti]]
+    for si, (size, price) in enumerate(prices.items()):
+        cb = f"add_item|{ci}|{mi}|t|{ti}|{si}"
         kb.append([InlineKeyboardButton(text=f"{size} — {price} تومان", callback_data=cb)])
-    kb.append([InlineKeyboardButton(text="🔙 برگشت", callback_data=f"back_model_options|{car_name}|{model}")])
+    kb.append([InlineKeyboardButton(text="🔙 برگشت", callback_data=f"back_model_options|{ci}|{mi}")])
     kb.append([InlineKeyboardButton(text="🧾 سبد خرید", callback_data="view_cart")])
     return InlineKeyboardMarkup(kb)
 
-def part_confirm_keyboard(car_name: str, model: str, part_name: str, price: int):
-    cb_add = f"add_item|{car_name}|{model}|{part_name}|1|{price}"
+@functools.lru_cache(maxsize=None)
+def part_confirm_keyboard(ci: int, mi: int, pi: int):
+    _, price = PART_META[MENU_PARTS[pi]]
+    cb_add = f"add_item|{ci}|{mi}|p|{pi}"
     kb = [
         [InlineKeyboardButton(text=f"اضافه به سبد — {price} تومان", callback_data=cb_add)],
-        [InlineKeyboardButton(text="🔙 برگشت", callback_data=f"back_model_options|{car_name}|{model}")],
+        [InlineKeyboardButton(text="🔙 برگشت", callback_data=f"back_model_options|{ci}|{mi}")],
         [InlineKeyboardButton(text="🧾 سبد خرید", callback_data="view_cart")]
     ]
     return InlineKeyboardMarkup(kb)
 
-def cart_keyboard(user_id: int):
-    kb = []
-    cart = get_cart(user_id)
-    if cart.get("items"):
-        kb.append([InlineKeyboardButton(text="ثبت سفارش و ارسال به ادمین", callback_data="checkout")])
-        kb.append([InlineKeyboardButton(text="پاک کردن سبد", callback_data="clear_cart")])
-    kb.append([InlineKeyboardButton(text="🏠 منو اصلی", callback_data="back_main")])
-    return InlineKeyboardMarkup(kb)
+CART_KB_EMPTY = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(text="🏠 منو اصلی", callback_data="back_main")]]
+)
+CART_KB_NONEMPTY = InlineKeyboardMarkup([
+    [InlineKeyboardButton(text="ثبت سفارش و ارسال به ادمین", callback_data="checkout")],
+    [InlineKeyboardButton(text="پاک کردن سبد", callback_data="clear_cart")],
+    [InlineKeyboardButton(text="🏠 منو اصلی", callback_data="back_main")],
+])
+
+def _check_callback_lengths(markup: InlineKeyboardMarkup):
+    for row in markup.inline_keyboard:
+        for btn in row:
+            if btn.callback_data is not None:
+                encoded = len(btn.callback_data.encode("utf-8"))
+                assert encoded <= 64, f"callback_data over 64 bytes: {btn.callback_data!r}"
+
+def _warm_keyboards():
+    """Build every static markup once at import, so no click ever pays
+    for keyboard construction, and fail fast at deploy time if any
+    button would exceed Telegram's 64-byte callback_data limit."""
+    markups = [MAIN_MENU, CART_KB_EMPTY, CART_KB_NONEMPTY]
+    for ci, car in enumerate(CAR_IDX):
+        markups.append(models_keyboard(ci))
+        for mi in range(len(CARS[car])):
+            markups.append(model_options_keyboard(ci, mi))
+            for ti in range(len(TIRE_IDX)):
+                markups.append(tires_size_keyboard(ci, mi, ti))
+            for pi in range(len(MENU_PARTS)):
+                markups.append(part_confirm_keyboard(ci, mi, pi))
+    for markup in markups:
+        _check_callback_lengths(markup)
+
+_warm_keyboards()
+
+# Navigation screens are identical for every user, so the exact
+# (text, reply_markup) pairs are precomputed too.
+NAV_MAIN = ("منو اصلی:", MAIN_MENU)
+NAV_MODELS = {ci: (f"مدل‌های {car}:", models_keyboard(ci)) for ci, car in enumerate(CAR_IDX)}
+NAV_MODEL_OPTS = {
+    (ci, mi): (f"انتخاب برای {car} — {m}:", model_options_keyboard(ci, mi))
+    for ci, car in enumerate(CAR_IDX)
+    for mi, m in enumerate(CARS[car])
+}
 
 # --- Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     text = f"سلام {user.first_name}!\nبه ربات فروش قطعات خودرو خوش اومدی.\nیکی از برندها رو انتخاب کن:" 
-    await update.message.reply_text(text, reply_markup=main_menu_keyboard())
+    await update.message.reply_text(text, reply_markup=MAIN_MENU)
 
-async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    user_id = query.from_user.id
+# Each callback handler receives the payload after the first "|" and
+# parses only its own fields; the router is a single dict lookup.
+async def h_view_cart(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
+    await show_cart(query, context)
 
-    if data == "view_cart":
-        await show_cart(query, context)
-        return
-    if data == "back_main":
-        await query.message.edit_text("منو اصلی:", reply_markup=main_menu_keyboard())
-        return
-    if data.startswith("car|"):
-        _, car_name = data.split("|", 1)
-        await query.message.edit_text(f"مدل‌های " + car_name + ":", reply_markup=models_keyboard(car_name))
-        return
-    if data.startswith("model|"):
-        _, car_name, model = data.split("|", 2)
-        await query.message.edit_text(f"انتخاب برای {car_name} — {model}:", reply_markup=model_options_keyboard(car_name, model))
-        return
-    if data.startswith("tires_type|"):
-        _, car_name, model, tire_type = data.split("|", 3)
-        await query.message.edit_text(f"لاستیک {tire_type} — انتخاب سایز:", reply_markup=tires_size_keyboard(car_name, model, tire_type))
-        return
-    if data.startswith("part|"):
-        _, car_name, model, part_key = data.split("|", 3)
-        if part_key == "لایت‌بک":
-            price = OTHER_PARTS_PRICES.get("لایت‌بک خارجی", 205)
-            await query.message.edit_text(f"{part_key} — قیمت: {price} تومان", reply_markup=part_confirm_keyboard(car_name, model, "لایت‌بک خارجی", price))
-            return
-        price = OTHER_PARTS_PRICES.get(part_key, 100)
-        await query.message.edit_text(f"{part_key} — قیمت: {price} تومان", reply_markup=part_confirm_keyboard(car_name, model, part_key, price))
-        return
-    if data.startswith("add_item|"):
-        parts = data.split("|")
-        if len(parts) < 6:
-            await query.message.reply_text("دادهٔ محصول نامعتبر است.")
-            return
-        _, car_name, model, item_name, meta, price_str = parts
-        price = int(price_str)
-        item = {"car": car_name, "model": model, "name": item_name, "meta": meta, "price": price, "qty": 1}
+async def h_back_main(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
+    text, markup = NAV_MAIN
+    await query.message.edit_text(text, reply_markup=markup)
+
+async def h_car(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
+    text, markup = NAV_MODELS[int(rest)]
+    await query.message.edit_text(text, reply_markup=markup)
+
+async def h_model(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
+    ci, mi = map(int, rest.split("|", 1))
+    text, markup = NAV_MODEL_OPTS[(ci, mi)]
+    await query.message.edit_text(text, reply_markup=markup)
+
+async def h_tires_type(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
+    ci, mi, ti = map(int, rest.split("|", 2))
+    await query.message.edit_text(f"لاستیک {TIRE_IDX[ti]} — انتخاب سایز:", reply_markup=tires_size_keyboard(ci, mi, ti))
+
+async def h_part(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
+    ci, mi, pi = map(int, rest.split("|", 2))
+    part_key = MENU_PARTS[pi]
+    _, price = PART_META[part_key]
+    await query.message.edit_text(f"{part_key} — قیمت: {price} تومان", reply_markup=part_confirm_keyboard(ci, mi, pi))
+
+async def h_add_item(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
+    ci_s, mi_s, kind, payload = rest.split("|", 3)
+    ci, mi = int(ci_s), int(mi_s)
+    car_name = CAR_IDX[ci]
+    model = CARS[car_name][mi]
+    if kind == "t":
+        ti_s, si_s = payload.split("|", 1)
+        tire_type = TIRE_IDX[int(ti_s)]
+        size = TIRE_SIZES[tire_type][int(si_s)]
+        item_name = f"لاستیک {tire_type}"
+        meta = size
+        price = TIRES_PRICES[tire_type][size]
+    elif kind == "p":
+        item_name, price = PART_META[MENU_PARTS[int(payload)]]
+        meta = "1"
+    else:
+        raise ValueError(f"unknown add_item kind: {kind}")
+    user_id = query.from_user.id
+    async with USER_LOCKS[user_id]:
         cart = get_cart(user_id)
         cart_items = cart.get("items", [])
-        cart_items.append(item)
+        # Same product again just bumps the quantity instead of growing
+        # the cart by another row.
+        for existing in cart_items:
+            if (existing.car == car_name and existing.model == model
+                    and existing.name == item_name and existing.meta == meta):
+                existing.qty += 1
+                break
+        else:
+            cart_items.append(Item(car_name, model, item_name, meta, price))
         cart["items"] = cart_items
         update_cart(user_id, cart)
-        await query.message.reply_text(f"✅ '{item_name} ({meta})' به سبد اضافه شد — {price} تومان")
-        return
-    if data == "clear_cart":
+    await query.message.reply_text(f"✅ '{item_name} ({meta})' به سبد اضافه شد — {price} تومان")
+
+async def h_clear_cart(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
+    user_id = query.from_user.id
+    async with USER_LOCKS[user_id]:
         clear_cart(user_id)
-        await query.message.reply_text("🗑️ سبد خرید پاک شد.")
-        return
-    if data == "checkout":
-        await handle_checkout(query, context)
-        return
-    if data.startswith("back_models|"):
-        _, car_name = data.split("|", 1)
-        await query.message.edit_text(f"مدل‌های " + car_name + ":", reply_markup=models_keyboard(car_name))
-        return
-    if data.startswith("back_model_options|"):
-        _, car_name, model = data.split("|", 2)
-        await query.message.edit_text(f"انتخاب برای {car_name} — {model}:", reply_markup=model_options_keyboard(car_name, model))
-        return
+    await query.message.reply_text("🗑️ سبد خرید پاک شد.")
 
+async def h_checkout(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
+    await handle_checkout(query, context)
+
+async def h_fallback(rest: str, query, context: ContextTypes.DEFAULT_TYPE):
     await query.message.reply_text("عملیات نامعتبر یا منقضی شده. از منو استفاده کن.")
 
-async def show_cart(query, context: ContextTypes.DEFAULT_TYPE):
-    user_id = query.from_user.id
-    cart = get_cart(user_id)
-    items = cart.get("items", [])
-    if not items:
-        await query.message.edit_text("سبد خرید شما خالی است.", reply_markup=cart_keyboard(user_id))
+HANDLERS = {
+    "view_cart": h_view_cart,
+    "back_main": h_back_main,
+    "car": h_car,
+    "model": h_model,
+    "tires_type": h_tires_type,
+    "part": h_part,
+    "add_item": h_add_item,
+    "clear_cart": h_clear_cart,
+    "checkout": h_checkout,
+    "back_models": h_car,
+    "back_model_options": h_model,
+}
+
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    data = query.data
+    # Telegram caps callback_data at 64 bytes; anything longer is not
+    # ours, so skip the parsing work entirely.
+    if not data or len(data) > 64:
         return
+    prefix, _, rest = data.partition("|")
+    try:
+        await HANDLERS.get(prefix, h_fallback)(rest, query, context)
+    except (ValueError, KeyError, IndexError):
+        # Malformed payload, e.g. a button from an older bot version.
+        await h_fallback(rest, query, context)
+
+def _format_cart(items):
+    """Render the numbered item list plus total; returns (text, total)."""
     lines = []
+    append = lines.append
     total = 0
     for i, it in enumerate(items, 1):
-        subtotal = it["price"] * it["qty"]
+        qty = it.qty
+        subtotal = it.price * qty
         total += subtotal
-        lines.append(f"{i}. {it['car']} - {it['model']} - {it['name']} ({it['meta']}) ×{it['qty']} = {subtotal} تومان")
-    lines.append(f"\nجمع کل: {total} تومان")
-    await query.message.edit_text("\n".join(lines), reply_markup=cart_keyboard(user_id))
+        append(f"{i}. {it.car} - {it.model} - {it.name} ({it.meta}) ×{qty} = {subtotal} تومان")
+    append(f"\nجمع کل: {total} تومان")
+    return "\n".join(lines), total
 
-async def handle_checkout(query, context: ContextTypes.DEFAULT_TYPE):
-    user = query.from_user
-    user_id = user.id
+async def show_cart(query, context: ContextTypes.DEFAULT_TYPE):
+    user_id = query.from_user.id
     cart = get_cart(user_id)
     items = cart.get("items", [])
     if not items:
-        await query.message.reply_text("سبد خرید خالی است.")
-        return
-    lines = [f"سفارش جدید از @{user.username if user.username else user.first_name} (id: {user_id})"]
-    total = 0
-    for i, it in enumerate(items, 1):
-        subtotal = it["price"] * it["qty"]
-        total += subtotal
-        lines.append(f"{i}. {it['car']} - {it['model']} - {it['name']} ({it['meta']}) ×{it['qty']} = {subtotal} تومان")
-    lines.append(f"\nجمع کل: {total} تومان")
-    text = "\n".join(lines)
-    try:
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID_INT, text=text)
-    except Exception as e:
-        logger.exception("Failed to send order to admin")
-        await query.message.reply_text("خطا در ارسال سفارش. لطفا بعداً دوباره تلاش کن.")
+        await query.message.edit_text("سبد خرید شما خالی است.", reply_markup=CART_KB_EMPTY)
         return
-    clear_cart(user_id)
+    text, _ = _format_cart(items)
+    await query.message.edit_text(text, reply_markup=CART_KB_NONEMPTY)
+
+ADMIN_SEND_RETRIES = 3
+
+async def _send_admin_with_retry(bot, text: str):
+    delay = 1.0
+    for attempt in range(1, ADMIN_SEND_RETRIES + 1):
+        try:
+            await bot.send_message(chat_id=ADMIN_CHAT_ID_INT, text=text)
+            return
+        except RetryAfter as exc:
+            await asyncio.sleep(exc.retry_after + 0.5)
+        except TelegramError as exc:
+            # Also covers persistent failures like Forbidden/BadRequest;
+            # retrying those is futile but cheap, and the fallthrough
+            # below guarantees the order still reaches the log.
+            logger.warning("Admin send failed (attempt %d/%d): %s", attempt, ADMIN_SEND_RETRIES, exc)
+            await asyncio.sleep(delay)
+            delay *= 2
+    # Last resort: keep the order in the log so it is not lost.
+    logger.error("Could not deliver order to admin after %d attempts:\n%s", ADMIN_SEND_RETRIES, text)
+
+async def handle_checkout(query, context: ContextTypes.DEFAULT_TYPE):
+    user = query.from_user
+    user_id = user.id
+    async with USER_LOCKS[user_id]:
+        cart = get_cart(user_id)
+        items = cart.get("items", [])
+        if not items:
+            await query.message.reply_text("سبد خرید خالی است.")
+            return
+        header = f"سفارش جدید از @{user.username if user.username else user.first_name} (id: {user_id})"
+        body, _ = _format_cart(items)
+        text = header + "\n" + body
+        # Admin delivery retries in the background; the user gets an
+        # immediate acknowledgement instead of waiting out a slow send.
+        context.application.create_task(_send_admin_with_retry(context.bot, text))
+        clear_cart(user_id)
     await query.message.reply_text("✅ سفارش شما با موفقیت ارسال شد. ما به زودی با شما تماس می‌گیریم.")
 
 async def cart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -257,39 +556,44 @@ async def cart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not items:
         await update.message.reply_text("سبد خرید شما خالی است.")
         return
-    lines = []
-    total = 0
-    for i, it in enumerate(items, 1):
-        subtotal = it["price"] * it["qty"]
-        total += subtotal
-        lines.append(f"{i}. {it['car']} - {it['model']} - {it['name']} ({it['meta']}) ×{it['qty']} = {subtotal} تومان")
-    lines.append(f"\nجمع کل: {total} تومان")
-    await update.message.reply_text("\n".join(lines))
+    text, _ = _format_cart(items)
+    await update.message.reply_text(text)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("از دکمه‌ها برای انتخاب ماشین، مدل و قطعه استفاده کن. /cart برای دیدن سبد، /start برای منو")
 
-# --- Flask routes for Webhook ---
-@app.route(f"/{BOT_TOKEN}", methods=["POST"])
-def webhook():
-    update = Update.de_json(request.get_json(force=True), bot_app.bot)
-    bot_app.dispatcher.process_update(update)
-    return "OK"
-
-@app.route("/")
-def index():
-    return "Telegram bot is running!"
-
 # --- App start ---
-bot_app = ApplicationBuilder().token(BOT_TOKEN).build()
+bot_app = (
+    ApplicationBuilder()
+    .token(BOT_TOKEN)
+    .rate_limiter(AIORateLimiter(max_retries=3))
+    .post_init(_start_flusher)
+    .post_shutdown(_flush_on_shutdown)
+    .build()
+)
 bot_app.add_handler(CommandHandler("start", start))
 bot_app.add_handler(CommandHandler("cart", cart_command))
 bot_app.add_handler(CommandHandler("help", help_command))
 bot_app.add_handler(CallbackQueryHandler(callback_router))
 
+LOCK_FILE = "/tmp/telegram_cars_bot.lock"
+
+def _acquire_instance_lock():
+    """Exit if another bot process is already running.
+
+    Two instances serving the same token hammer Telegram with competing
+    requests (409 Conflict storms); better to fail fast at startup."""
+    lock = open(LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise SystemExit("another instance is already running, exiting")
+    return lock
+
 if __name__ == "__main__":
+    _instance_lock = _acquire_instance_lock()
     webhook_url = f"{WEBHOOK_URL}/{BOT_TOKEN}"
-    logger.info(f"Setting webhook to: {webhook_url}")
+    logger.info("Setting webhook to: %s", webhook_url)
     bot_app.run_webhook(
         listen="0.0.0.0",
         port=PORT,